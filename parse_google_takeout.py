@@ -1,17 +1,25 @@
 import csv
 from enum import Enum
-import json
-from calendar import month_abbr
-from collections import Counter, defaultdict
+from itertools import islice
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+from calendar import month_abbr, month_name
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, date, tzinfo
 from pathlib import Path
+from zoneinfo import ZoneInfo
 from typing import (
-    DefaultDict,
+    BinaryIO,
     Dict,
     NamedTuple,
     Set,
     Tuple,
     Iterable,
+    Iterator,
     List,
     Optional,
     TypedDict,
@@ -22,19 +30,89 @@ import click
 import dateutil.parser
 import holidays
 from holidays.holiday_base import HolidayBase
-import pytz
+import ijson
+from numba import njit, prange, set_num_threads
+import numpy as np
+import orjson
+import shapely
 from shapely.geometry.polygon import Polygon
+from shapely.strtree import STRtree
 import us
-from haversine import haversine
-from shapely.geometry.point import Point
 from shapely.geometry import shape
 
-UTC = pytz.utc
+logger = logging.getLogger(__name__)
 
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+MS_PER_DAY = 86_400_000
+# Bump when a change to parsing invalidates cached Semantic Location results
+PARSE_CACHE_VERSION = 4
+# Geocoder results are memoized on coordinates rounded to this many decimals
+CACHE_PRECISION = 5
+# find_state_batch caches whole 1/GRID_CELLS_PER_DEGREE degree cells (~1km)
+GRID_CELLS_PER_DEGREE = 100
+# Month files larger than this are streamed instead of parsed in one go
+STREAM_MONTH_FILE_BYTES = 64 << 20
+# Fewer pending month files than this are parsed without a process pool
+MIN_POOL_MONTHS = 3
+# Semantic Location segments are attributed in batches of this many
+SEGMENT_CHUNK_SIZE = 4096
+# Semantic Location History month files are named like 2019_JANUARY.json
+MONTH_NUMBERS = {name.upper(): number for number, name in enumerate(month_name) if name}
+# Mean earth radius in km
+EARTH_RADIUS_KM = 6371.0088
 
-def daterange(start_date: date, end_date: date) -> Iterable[date]:
-    for n in range(int((end_date - start_date).days) + 1):
-        yield start_date + timedelta(n)
+
+def daterange(start_date: date, end_date: date) -> List[date]:
+    return [
+        date.fromordinal(ordinal)
+        for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1)
+    ]
+
+
+@njit(cache=True, fastmath=True)
+def _min_office_dist2(lat: float, lng: float, offices_rad: np.ndarray) -> float:
+    """Squared angular distance from (lat, lng) to the closest office.
+
+    Uses the equirectangular approximation, which is accurate to well under a
+    meter at the sub-kilometer scale of the office threshold.
+    """
+    lat_rad = np.radians(lat)
+    lng_rad = np.radians(lng)
+    cos_lat = np.cos(lat_rad)
+    min_dist2 = np.inf
+    for i in range(offices_rad.shape[0]):
+        dlat = offices_rad[i, 0] - lat_rad
+        dlng = (offices_rad[i, 1] - lng_rad) * cos_lat
+        min_dist2 = min(min_dist2, dlat * dlat + dlng * dlng)
+    return min_dist2
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _near_office_batch(
+    lats: np.ndarray, lngs: np.ndarray, offices_rad: np.ndarray, threshold2: float
+) -> np.ndarray:
+    result = np.empty(lats.shape[0], dtype=np.bool_)
+    for i in prange(lats.shape[0]):
+        result[i] = _min_office_dist2(lats[i], lngs[i], offices_rad) < threshold2
+    return result
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _any_near_office_segments(
+    lats: np.ndarray,
+    lngs: np.ndarray,
+    bounds: np.ndarray,
+    offices_rad: np.ndarray,
+    threshold2: float,
+) -> np.ndarray:
+    # Points bounds[s]:bounds[s + 1] belong to segment s
+    result = np.zeros(bounds.shape[0] - 1, dtype=np.bool_)
+    for s in prange(bounds.shape[0] - 1):
+        for i in range(bounds[s], bounds[s + 1]):
+            if _min_office_dist2(lats[i], lngs[i], offices_rad) < threshold2:
+                result[s] = True
+                break
+    return result
 
 
 class Location(NamedTuple):
@@ -42,14 +120,6 @@ class Location(NamedTuple):
     lng: float
 
 
-class ParsedVisit(NamedTuple):
-    location: Location
-    state: str
-    start_date: date
-    end_date: Optional[date]
-    near_office: bool
-
-
 class LocationVisit(TypedDict):
     latitudeE7: int
     longitudeE7: int
@@ -105,6 +175,19 @@ class TimelineMonth(TypedDict):
     timelineObjects: List[TimelineObject]
 
 
+class Segment(NamedTuple):
+    """A place visit or activity segment decoded from a timeline object.
+
+    Place visits start and end at the same location and have no waypoints.
+    """
+
+    start: Location
+    end: Location
+    start_ms: int
+    end_ms: int
+    waypoints: List[Waypoint]
+
+
 class DayType(Enum):
     WEEKEND = "W"
     HOLIDAY = "H"
@@ -112,6 +195,78 @@ class DayType(Enum):
     VACATION = "V"
 
 
+class VisitMap:
+    """Distinct (state, near_office) visits per day.
+
+    Days are keyed by ordinal and each visit is encoded as a small int,
+    ``state_id << 1 | near_office``. A per-day bitmap of the codes seen
+    answers membership without hashing, while a short list keeps the visits
+    in the order they were first seen.
+    """
+
+    def __init__(self) -> None:
+        self.state_names: List[str] = []
+        self._state_ids: Dict[str, int] = {}
+        self._seen: Dict[int, int] = {}
+        self._visits: Dict[int, List[int]] = {}
+
+    def _state_id(self, state: str) -> int:
+        state_id = self._state_ids.get(state)
+        if state_id is None:
+            state_id = self._state_ids[state] = len(self.state_names)
+            self.state_names.append(state)
+        return state_id
+
+    def add(self, d: date, state: str, near_office: bool) -> None:
+        self.add_ordinal(d.toordinal(), state, near_office)
+
+    def add_ordinal(self, ordinal: int, state: str, near_office: bool) -> None:
+        self._add(ordinal, self._state_id(state) << 1 | near_office)
+
+    def _add(self, ordinal: int, code: int) -> None:
+        seen = self._seen.get(ordinal, 0)
+        if not seen:
+            self._seen[ordinal] = 1 << code
+            self._visits[ordinal] = [code]
+        elif not seen >> code & 1:
+            self._seen[ordinal] = seen | 1 << code
+            self._visits[ordinal].append(code)
+
+    def contains(self, d: date, state: str, near_office: bool) -> bool:
+        state_id = self._state_ids.get(state)
+        if state_id is None:
+            return False
+        code = state_id << 1 | near_office
+        return bool(self._seen.get(d.toordinal(), 0) >> code & 1)
+
+    def visits(self, ordinal: int) -> List[Tuple[str, bool]]:
+        return [
+            (self.state_names[code >> 1], bool(code & 1))
+            for code in self._visits.get(ordinal, ())
+        ]
+
+    def to_data(self) -> Tuple[List[str], Dict[int, List[int]]]:
+        """Plain builtins for serializing, independent of this module's name."""
+        return self.state_names, self._visits
+
+    @classmethod
+    def from_data(cls, data: Tuple[List[str], Dict[int, List[int]]]) -> "VisitMap":
+        state_names, visits = data
+        result = cls()
+        for state in state_names:
+            result._state_id(state)
+        for ordinal, codes in visits.items():
+            for code in codes:
+                result._add(ordinal, code)
+        return result
+
+    def update(self, other: "VisitMap") -> None:
+        state_ids = [self._state_id(state) for state in other.state_names]
+        for ordinal, codes in other._visits.items():
+            for code in codes:
+                self._add(ordinal, state_ids[code >> 1] << 1 | code & 1)
+
+
 class Geocoder:
     def __init__(
         self,
@@ -120,56 +275,238 @@ class Geocoder:
         office_locations: List[Location],
         office_distance_threshold_km: float = 0.75,
     ) -> None:
-        print("\tParsing States geojson...", end="", flush=True)
+        logger.debug("Parsing States geojson...")
         self.states_geojson: List[Tuple[str, Polygon]] = self._load_geojson(
             states_geojson_file, "NAME"
         )
-        print("Done")
-        print("\tParsing Countries geojson...", end="", flush=True)
+        logger.debug("Parsing Countries geojson...")
         self.countries_geojson: List[Tuple[str, Polygon]] = self._load_geojson(
             countries_geojson_file, "ADMIN"
         )
-        print("Done")
+        # Identifies the inputs results depend on, for on-disk caches
+        self.cache_key = (
+            tuple(
+                (str(f.resolve()), f.stat().st_mtime_ns, f.stat().st_size)
+                for f in (states_geojson_file, countries_geojson_file)
+            ),
+            tuple(office_locations),
+            office_distance_threshold_km,
+        )
+        self._setup(office_locations, office_distance_threshold_km)
+
+    def _setup(
+        self,
+        office_locations: List[Location],
+        office_distance_threshold_km: float,
+    ) -> None:
+        self._state_names, self._state_tree = self._build_index(self.states_geojson)
+        self._country_names, self._country_tree = self._build_index(
+            self.countries_geojson
+        )
+        # Points outside every state skip straight to the countries
+        self._states_bounds = tuple(
+            shapely.total_bounds(self._state_tree.geometries).tolist()
+        )
         self.office_locations = office_locations
         self.office_distance_threshold_km = office_distance_threshold_km
+        self._offices_rad = np.radians(
+            np.array([(o.lat, o.lng) for o in office_locations], dtype=np.float64)
+        ).reshape(-1, 2)
+        # Office kernels compare squared angular distances, skipping the sqrt
+        self._office_threshold2 = (office_distance_threshold_km / EARTH_RADIUS_KM) ** 2
+        # Cells whose corners all resolve to the same state
+        self._grid_cache: Dict[Tuple[int, int], Optional[str]] = {}
+        self._boundary_cells: Set[Tuple[int, int]] = set()
+        # Visits cluster heavily, memoize lookups per ~1m grid cell
+        self._point_cache: Dict[Tuple[float, float], Optional[str]] = {}
+
+    def __getstate__(self) -> Tuple:
+        # Polygons lose their prepared state when pickled, ship the raw
+        # polygons to worker processes and rebuild the indexes there.
+        return (
+            self.states_geojson,
+            self.countries_geojson,
+            self.office_locations,
+            self.office_distance_threshold_km,
+            self.cache_key,
+        )
+
+    def __setstate__(self, state: Tuple) -> None:
+        (
+            states,
+            countries,
+            office_locations,
+            office_distance_threshold_km,
+            self.cache_key,
+        ) = state
+        for _, polygon in states + countries:
+            shapely.prepare(polygon)
+        self.states_geojson = states
+        self.countries_geojson = countries
+        self._setup(office_locations, office_distance_threshold_km)
 
     @staticmethod
     def _load_geojson(
         geojson_file: Path,
         name_key: str,
     ) -> List[Tuple[str, Polygon]]:
-        result = {}
-        states_geojson = json.loads(geojson_file.read_text(encoding="utf8"))
-        for feature in states_geojson["features"]:
-            result[feature["properties"][name_key]] = shape(feature["geometry"]).buffer(
-                0.005
+        geojson = orjson.loads(geojson_file.read_bytes())
+        result = [
+            (feature["properties"][name_key], shape(feature["geometry"]).buffer(0.005))
+            for feature in geojson["features"]
+        ]
+        # Prepare in place so contains() uses GEOS' cached edge index
+        shapely.prepare([polygon for _, polygon in result])
+        return result
+
+    @staticmethod
+    def _build_index(
+        geojson: List[Tuple[str, Polygon]],
+    ) -> Tuple[List[str], STRtree]:
+        names = [name for name, _ in geojson]
+        return names, STRtree([polygon for _, polygon in geojson])
+
+    @staticmethod
+    def _lookup_batch(
+        lats: np.ndarray,
+        lngs: np.ndarray,
+        tree: STRtree,
+    ) -> np.ndarray:
+        """Index of the first polygon containing each point, -1 if none does."""
+        polygons = tree.geometries
+        point_indices, polygon_indices = tree.query(shapely.points(lngs, lats))
+        hits = shapely.contains_xy(
+            polygons[polygon_indices], lngs[point_indices], lats[point_indices]
+        )
+        # Check candidates in load order so overlapping borders resolve stably
+        first = np.full(len(lats), len(polygons), dtype=np.intp)
+        np.minimum.at(first, point_indices[hits], polygon_indices[hits])
+        first[first == len(polygons)] = -1
+        return first
+
+    def _find_state_batch(
+        self, lats: np.ndarray, lngs: np.ndarray
+    ) -> List[Optional[str]]:
+        """State, or "Outside US/<country>", containing each point."""
+        names: List[Optional[str]] = [None] * len(lats)
+        min_lng, min_lat, max_lng, max_lat = self._states_bounds
+        in_bounds = np.flatnonzero(
+            (min_lat <= lats)
+            & (lats <= max_lat)
+            & (min_lng <= lngs)
+            & (lngs <= max_lng)
+        )
+        state_indices = self._lookup_batch(
+            lats[in_bounds], lngs[in_bounds], self._state_tree
+        )
+        for i, state_index in zip(in_bounds.tolist(), state_indices.tolist()):
+            if state_index >= 0:
+                names[i] = self._state_names[state_index]
+        missing = np.array(
+            [i for i, name in enumerate(names) if name is None], dtype=np.intp
+        )
+        country_indices = self._lookup_batch(
+            lats[missing], lngs[missing], self._country_tree
+        )
+        for i, country_index in zip(missing.tolist(), country_indices.tolist()):
+            if country_index >= 0:
+                names[i] = f"Outside US/{self._country_names[country_index]}"
+        return names
+
+    def _resolve_batch(
+        self, coordinates: Iterable[Tuple[float, float]]
+    ) -> Dict[Tuple[float, float], Optional[str]]:
+        unique = list(dict.fromkeys(coordinates))
+        misses = [
+            coordinate for coordinate in unique if coordinate not in self._point_cache
+        ]
+        coords = np.array(misses, dtype=np.float64).reshape(-1, 2)
+        self._point_cache.update(
+            zip(misses, self._find_state_batch(coords[:, 0], coords[:, 1]))
+        )
+        return {coordinate: self._point_cache[coordinate] for coordinate in unique}
+
+    def find_state_batch(
+        self, lats: np.ndarray, lngs: np.ndarray
+    ) -> List[Optional[str]]:
+        """State containing each point, geocoding every cache miss in bulk.
+
+        Points are cached per 1/GRID_CELLS_PER_DEGREE degree cell when all
+        four of the cell's corners agree, and per coordinate rounded to
+        CACHE_PRECISION decimals otherwise.
+        """
+        cells = list(
+            zip(
+                np.floor(lats * GRID_CELLS_PER_DEGREE).astype(np.int64).tolist(),
+                np.floor(lngs * GRID_CELLS_PER_DEGREE).astype(np.int64).tolist(),
+            )
+        )
+        new_cells = [
+            cell
+            for cell in dict.fromkeys(cells)
+            if cell not in self._grid_cache and cell not in self._boundary_cells
+        ]
+        if new_cells:
+            corners = [
+                [
+                    (
+                        round(
+                            (cell[0] + dlat) / GRID_CELLS_PER_DEGREE, CACHE_PRECISION
+                        ),
+                        round(
+                            (cell[1] + dlng) / GRID_CELLS_PER_DEGREE, CACHE_PRECISION
+                        ),
+                    )
+                    for dlat in (0, 1)
+                    for dlng in (0, 1)
+                ]
+                for cell in new_cells
+            ]
+            corner_states = self._resolve_batch(
+                corner for cell_corners in corners for corner in cell_corners
+            )
+            for cell, cell_corners in zip(new_cells, corners):
+                states = {corner_states[corner] for corner in cell_corners}
+                if len(states) == 1:
+                    self._grid_cache[cell] = states.pop()
+                else:
+                    self._boundary_cells.add(cell)
+        # Points in boundary cells are geocoded individually
+        boundary_coordinates = {
+            i: (round(lat, CACHE_PRECISION), round(lng, CACHE_PRECISION))
+            for i, (cell, lat, lng) in enumerate(
+                zip(cells, lats.tolist(), lngs.tolist())
             )
-        return list(result.items())
-
-    def find_state(self, location: Location) -> Optional[str]:
-        p = Point(location.lng, location.lat)
-        for index, (state_name, state_shape) in enumerate(self.states_geojson):
-            if p.within(state_shape):
-                # Keep most visited states towards the top
-                self.states_geojson.insert(0, self.states_geojson.pop(index))
-                return state_name
-        for index, (country_name, country_shape) in enumerate(self.countries_geojson):
-            if p.within(country_shape):
-                # Keep most visited countries towards the top
-                self.countries_geojson.insert(0, self.countries_geojson.pop(index))
-                return f"Outside US/{country_name}"
-        return None
-
-    def is_near_office(self, location: Location) -> bool:
-        for office_location in self.office_locations:
-            if haversine(location, office_location) < self.office_distance_threshold_km:
-                return True
-        return False
+            if cell not in self._grid_cache
+        }
+        boundary_states = self._resolve_batch(boundary_coordinates.values())
+        return [
+            (
+                boundary_states[boundary_coordinates[i]]
+                if i in boundary_coordinates
+                else self._grid_cache[cell]
+            )
+            for i, cell in enumerate(cells)
+        ]
+
+    def near_office_batch(self, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        return _near_office_batch(
+            lats, lngs, self._offices_rad, self._office_threshold2
+        )
+
+    def any_near_office_segments(
+        self, lats: np.ndarray, lngs: np.ndarray, bounds: np.ndarray
+    ) -> np.ndarray:
+        """Whether any point in each run bounds[s]:bounds[s + 1] is near an office."""
+        return _any_near_office_segments(
+            lats, lngs, bounds, self._offices_rad, self._office_threshold2
+        )
 
 
 class Calendar:
     def __init__(self, working_holidays: List[str]) -> None:
         self._holiday_cache: Dict[int, HolidayBase] = {}
+        self._day_type_cache: Dict[date, DayType] = {}
         self.working_holidays = working_holidays
 
     def _populate_year(self, year: int) -> None:
@@ -186,7 +523,16 @@ class Calendar:
         holidays_for_year[christmas_eve] = "Christmas Eve"
         self._holiday_cache[year] = holidays_for_year
 
-    def day_type(self, d: date) -> bool:
+    def warmup(self, start_date: date, end_date: date) -> None:
+        for d in daterange(start_date, end_date):
+            self.day_type(d)
+
+    def day_type(self, d: date) -> DayType:
+        if d not in self._day_type_cache:
+            self._day_type_cache[d] = self._day_type(d)
+        return self._day_type_cache[d]
+
+    def _day_type(self, d: date) -> DayType:
         if d.year not in self._holiday_cache:
             self._populate_year(d.year)
         if d.weekday() in [5, 6]:
@@ -203,147 +549,397 @@ class TakeoutParser:
         calendar: Calendar,
         timezone: tzinfo,
         takeout_dir: Path,
+        cache_dir: Optional[Path] = None,
     ) -> None:
         self.geocoder = geocoder
         self.calendar = calendar
         self.timezone = timezone
         self.takeout_dir = takeout_dir
+        self.cache_dir = cache_dir
+        utc_transitions, utc_offsets = self._load_utc_offsets(timezone)
+        self._utc_transitions = np.array(utc_transitions, dtype=np.int64)
+        self._utc_offsets = np.array(utc_offsets, dtype=np.int64)
+
+    @staticmethod
+    def _load_utc_offsets(timezone: tzinfo) -> Tuple[List[int], List[int]]:
+        """Epoch seconds of each UTC offset change and the offset from then on.
+
+        zoneinfo doesn't expose its transitions, so sample the offset once a day
+        and bisect every change down to the second.
+        """
 
-    def parse_place_visit(self, visit: PlaceVisit) -> ParsedVisit:
+        def offset_at(seconds: int) -> int:
+            return int(
+                datetime.fromtimestamp(seconds, timezone).utcoffset().total_seconds()
+            )
+
+        end = (date(date.today().year + 2, 1, 1).toordinal() - EPOCH_ORDINAL) * 86400
+        transitions = [0]
+        offsets = [offset_at(0)]
+        for seconds in range(86400, end, 86400):
+            offset = offset_at(seconds)
+            if offset == offsets[-1]:
+                continue
+            before, after = seconds - 86400, seconds
+            while after - before > 1:
+                middle = (before + after) // 2
+                if offset_at(middle) == offsets[-1]:
+                    before = middle
+                else:
+                    after = middle
+            transitions.append(after)
+            offsets.append(offset)
+        return transitions, offsets
+
+    @staticmethod
+    def decode_place_visit(visit: PlaceVisit) -> Segment:
         visit_location = visit["location"]
         location = Location(
             visit_location["latitudeE7"] / 1e7,
             visit_location["longitudeE7"] / 1e7,
         )
-        near_office = False
-        start_timestamp = datetime.fromtimestamp(
-            int(visit["duration"]["startTimestampMs"]) / 1000, UTC
-        )
-        end_timestamp = datetime.fromtimestamp(
-            int(visit["duration"]["endTimestampMs"]) / 1000, UTC
-        )
-        state = self.geocoder.find_state(location) or ""
-        near_office = self.geocoder.is_near_office(location)
-
-        return ParsedVisit(
+        return Segment(
+            location,
             location,
-            state.strip(),
-            start_timestamp.astimezone(self.timezone).date(),
-            end_timestamp.astimezone(self.timezone).date(),
-            near_office,
+            int(visit["duration"]["startTimestampMs"]),
+            int(visit["duration"]["endTimestampMs"]),
+            [],
         )
 
-    def parse_activity(self, visit: ActivitySegment) -> ParsedVisit:
+    @staticmethod
+    def decode_activity(visit: ActivitySegment) -> Segment:
         start = visit["startLocation"]
         end = visit["endLocation"]
-        start_location = Location(
-            start["latitudeE7"] / 1e7,
-            start["longitudeE7"] / 1e7,
-        )
-        end_location = Location(
-            end["latitudeE7"] / 1e7,
-            end["longitudeE7"] / 1e7,
-        )
-        near_office = False
-        start_timestamp = datetime.fromtimestamp(
-            int(visit["duration"]["startTimestampMs"]) / 1000, UTC
-        )
-        end_timestamp = datetime.fromtimestamp(
-            int(visit["duration"]["endTimestampMs"]) / 1000, UTC
-        )
-        start_near_office = self.geocoder.is_near_office(start_location)
-        start_state = self.geocoder.find_state(start_location) or ""
-        end_near_office = self.geocoder.is_near_office(end_location)
-        end_state = self.geocoder.find_state(end_location) or ""
-        near_office = start_near_office or end_near_office
-        if not near_office and "waypointPath" in visit:
-            for waypoint in visit["waypointPath"]["waypoints"]:
-                location = Location(waypoint["latE7"] / 1e7, waypoint["lngE7"] / 1e7)
-                if self.geocoder.is_near_office(location):
-                    near_office = True
-                    break
-
-        return ParsedVisit(
-            start_location,
-            start_state.strip() if start_near_office else end_state.strip(),
-            start_timestamp.astimezone(self.timezone).date(),
-            end_timestamp.astimezone(self.timezone).date(),
-            near_office,
+        return Segment(
+            Location(start["latitudeE7"] / 1e7, start["longitudeE7"] / 1e7),
+            Location(end["latitudeE7"] / 1e7, end["longitudeE7"] / 1e7),
+            int(visit["duration"]["startTimestampMs"]),
+            int(visit["duration"]["endTimestampMs"]),
+            visit.get("waypointPath", {}).get("waypoints") or [],
         )
 
+    @classmethod
+    def decode_timeline(
+        cls, timeline_objects: Iterable[TimelineObject]
+    ) -> Iterator[Segment]:
+        for timeline_object in timeline_objects:
+            if "placeVisit" in timeline_object:
+                visit = timeline_object["placeVisit"]
+                if "location" in visit:
+                    yield cls.decode_place_visit(visit)
+            elif "activitySegment" in timeline_object:
+                activity = timeline_object["activitySegment"]
+                if (
+                    "startLocation" in activity
+                    and "latitudeE7" in activity["startLocation"]
+                ):
+                    yield cls.decode_activity(activity)
+
+    @staticmethod
+    def _state_location(segment: Segment, start_near_office: bool) -> Location:
+        # A segment is attributed to its start if that is near an office and
+        # to its end otherwise, only that end needs geocoding.
+        return segment.start if start_near_office else segment.end
+
     def parse_location_history_file(
         self,
-        result: DefaultDict[date, Set[Tuple[str, bool]]],
+        result: VisitMap,
         start_date: date,
         end_date: date,
     ) -> None:
-        print("\tParsing Location History.json...", end="", flush=True)
+        logger.debug("Parsing Location History.json...")
         location_history_file = (
             self.takeout_dir / "Location History" / "Location History.json"
         )
-        location_history: LocationHistory = json.loads(
-            location_history_file.read_text(encoding="utf8")
-        )
-        print("Done")
-        print("\tProcessesing Location History.json...", end="", flush=True)
-        for location in location_history["locations"]:
-            location_timestamp = datetime.fromtimestamp(
-                int(location["timestampMs"]) / 1000
-            ).astimezone(self.timezone)
-            if not (start_date <= location_timestamp.date() <= end_date):
-                continue
-            location = Location(
-                location["latitudeE7"] / 1e7,
-                location["longitudeE7"] / 1e7,
+        # Local days are resolved later, keep a day of slack on either side
+        start_ms = (start_date.toordinal() - EPOCH_ORDINAL - 1) * MS_PER_DAY
+        end_ms = (end_date.toordinal() - EPOCH_ORDINAL + 2) * MS_PER_DAY
+        with location_history_file.open("rb") as fp:
+            samples = np.fromiter(
+                self._read_location_history(fp, start_ms, end_ms),
+                dtype=[
+                    ("timestamp_ms", np.int64),
+                    ("lat_e7", np.int64),
+                    ("lng_e7", np.int64),
+                ],
             )
-            state = self.geocoder.find_state(location) or ""
-            if (state, True) in result[location_timestamp.date()]:
+        logger.debug("Processing Location History.json...")
+        timestamps_ms = samples["timestamp_ms"]
+        lats_e7 = samples["lat_e7"]
+        lngs_e7 = samples["lng_e7"]
+        days = self._local_days(timestamps_ms)
+        in_range = (days >= start_date.toordinal()) & (days <= end_date.toordinal())
+        # Collapse samples to unique (day, grid cell) pairs before geocoding
+        grid_scale = 10 ** (7 - CACHE_PRECISION)
+        cells = np.unique(
+            np.stack(
+                [
+                    days[in_range],
+                    (lats_e7[in_range] + grid_scale // 2) // grid_scale,
+                    (lngs_e7[in_range] + grid_scale // 2) // grid_scale,
+                ],
+                axis=1,
+            ),
+            axis=0,
+        )
+        lats = cells[:, 1] / 10**CACHE_PRECISION
+        lngs = cells[:, 2] / 10**CACHE_PRECISION
+        # Being near an office only counts on working days, skip the check on
+        # the rest. Their samples are recorded as not near an office, which
+        # can change the state shown for holidays and vacation days.
+        unique_days, day_index = np.unique(cells[:, 0], return_inverse=True)
+        working_days = np.array(
+            [
+                self.calendar.day_type(date.fromordinal(day)) == DayType.WORKING
+                for day in unique_days.tolist()
+            ],
+            dtype=np.bool_,
+        )
+        working = working_days[day_index]
+        near_offices = np.zeros(len(cells), dtype=np.bool_)
+        near_offices[working] = self.geocoder.near_office_batch(
+            lats[working], lngs[working]
+        )
+        states = self.geocoder.find_state_batch(lats, lngs)
+        for day, state, near_office in zip(
+            cells[:, 0].tolist(), states, near_offices.tolist()
+        ):
+            location_date = date.fromordinal(day)
+            state = state or ""
+            if result.contains(location_date, state, True):
                 continue
-            near_office = self.geocoder.is_near_office(location)
-            result[location_timestamp.date()].add((state, near_office))
-        print("Done")
+            result.add(location_date, state, near_office)
+
+    @staticmethod
+    def _read_location_history(
+        fp: BinaryIO,
+        start_ms: int,
+        end_ms: int,
+    ) -> Iterator[Tuple[int, int, int]]:
+        location: LocationHistoryLocation
+        for location in ijson.items(fp, "locations.item"):
+            timestamp_ms = int(location["timestampMs"])
+            if start_ms <= timestamp_ms < end_ms:
+                yield timestamp_ms, location["latitudeE7"], location["longitudeE7"]
+
+    def _local_days(self, timestamps_ms: np.ndarray) -> np.ndarray:
+        """Local calendar day ordinals for epoch millisecond timestamps."""
+        seconds = timestamps_ms // 1000
+        indices = np.searchsorted(self._utc_transitions, seconds, side="right") - 1
+        offsets = self._utc_offsets[np.maximum(indices, 0)]
+        return (seconds + offsets) // 86400 + EPOCH_ORDINAL
 
     def parse_semantic_location_file(
         self,
-        month: TimelineMonth,
-        result: DefaultDict[date, Set[Tuple[str, bool]]],
+        timeline_objects: Iterable[TimelineObject],
+        result: VisitMap,
     ) -> None:
-        timeline_objects = month["timelineObjects"]
-        for timeline_object in timeline_objects:
-            if "placeVisit" in timeline_object:
-                visit = timeline_object["placeVisit"]
-                if "location" in visit:
-                    parsed_visit = self.parse_place_visit(visit)
-                    result[parsed_visit.start_date].add(
-                        (parsed_visit.state, parsed_visit.near_office)
-                    )
-            elif "activitySegment" in timeline_object:
-                activity = timeline_object["activitySegment"]
-                if (
-                    "startLocation" in activity
-                    and "latitudeE7" in activity["startLocation"]
-                ):
-                    parsed_visit = self.parse_activity(activity)
-                    result[parsed_visit.start_date].add(
-                        (parsed_visit.state, parsed_visit.near_office)
-                    )
+        # Segments are independent, batch them in fixed size chunks so a
+        # streamed month never holds more than one chunk in memory
+        segments = self.decode_timeline(timeline_objects)
+        while chunk := list(islice(segments, SEGMENT_CHUNK_SIZE)):
+            self._parse_segments(chunk, result)
 
-    def parse_semantic_year(
+    def _parse_segments(self, segments: List[Segment], result: VisitMap) -> None:
+        # Resolve every segment's local start day in one vectorized pass
+        start_days = self._local_days(
+            np.fromiter(
+                (segment.start_ms for segment in segments),
+                dtype=np.int64,
+                count=len(segments),
+            )
+        )
+        # Check both ends of every segment against the offices in one batch
+        ends = [segment.start for segment in segments] + [
+            segment.end for segment in segments
+        ]
+        near_offices = self.geocoder.near_office_batch(
+            np.array([location.lat for location in ends], dtype=np.float64),
+            np.array([location.lng for location in ends], dtype=np.float64),
+        ).tolist()
+        start_near_offices = near_offices[: len(segments)]
+        # Geocode the attributed end of every segment in one batch
+        state_locations = [
+            self._state_location(segment, start_near_office)
+            for segment, start_near_office in zip(segments, start_near_offices)
+        ]
+        states = self.geocoder.find_state_batch(
+            np.array([location.lat for location in state_locations], dtype=np.float64),
+            np.array([location.lng for location in state_locations], dtype=np.float64),
+        )
+        end_near_offices = near_offices[len(segments) :]
+        # Only segments near an office at neither end need their waypoints
+        # checked, do all of them in one kernel call
+        waypoint_segments = [
+            i
+            for i, segment in enumerate(segments)
+            if segment.waypoints and not (start_near_offices[i] or end_near_offices[i])
+        ]
+        waypoints = [
+            waypoint for i in waypoint_segments for waypoint in segments[i].waypoints
+        ]
+        waypoint_lats = (
+            np.fromiter(
+                (waypoint["latE7"] for waypoint in waypoints),
+                dtype=np.float64,
+                count=len(waypoints),
+            )
+            / 1e7
+        )
+        waypoint_lngs = (
+            np.fromiter(
+                (waypoint["lngE7"] for waypoint in waypoints),
+                dtype=np.float64,
+                count=len(waypoints),
+            )
+            / 1e7
+        )
+        # Segment s owns waypoints waypoint_bounds[s]:waypoint_bounds[s + 1]
+        waypoint_bounds = np.zeros(len(waypoint_segments) + 1, dtype=np.int64)
+        np.cumsum(
+            [len(segments[i].waypoints) for i in waypoint_segments],
+            out=waypoint_bounds[1:],
+        )
+        runs_near_office = self.geocoder.any_near_office_segments(
+            waypoint_lats, waypoint_lngs, waypoint_bounds
+        )
+        waypoints_near_office = dict(zip(waypoint_segments, runs_near_office.tolist()))
+        for i, (start_day, state) in enumerate(zip(start_days.tolist(), states)):
+            near_office = (
+                start_near_offices[i]
+                or end_near_offices[i]
+                or waypoints_near_office.get(i, False)
+            )
+            result.add_ordinal(start_day, (state or "").strip(), near_office)
+
+    def parse_month_file(self, month_file: Path) -> VisitMap:
+        result = VisitMap()
+        if month_file.stat().st_size > STREAM_MONTH_FILE_BYTES:
+            # Stream rather than decode the whole file into one dict
+            with month_file.open("rb") as fp:
+                self.parse_semantic_location_file(
+                    ijson.items(fp, "timelineObjects.item"), result
+                )
+        else:
+            month: TimelineMonth = orjson.loads(month_file.read_bytes())
+            self.parse_semantic_location_file(month["timelineObjects"], result)
+        return result
+
+    def parse_semantic_years(
         self,
-        year: int,
-        result: DefaultDict[date, Set[Tuple[str, bool]]],
+        years: Iterable[int],
+        result: VisitMap,
     ) -> None:
         semantic_location_dir = (
-            self.takeout_dir
-            / "Location History"
-            / "Semantic Location History"
-            / str(year)
+            self.takeout_dir / "Location History" / "Semantic Location History"
         )
-        for month_file in semantic_location_dir.glob(f"{year}_*.json"):
-            self.parse_semantic_location_file(
-                json.loads(month_file.read_text(encoding="utf8")),
-                result,
+        # Visits merge in first-seen order, so keep months chronological
+        month_files = [
+            month_file
+            for year in sorted(years)
+            for month_file in sorted(
+                (semantic_location_dir / str(year)).glob(f"{year}_*.json"),
+                key=_month_file_order,
             )
+        ]
+        month_results = {
+            month_file: self._load_cached_month(month_file)
+            for month_file in month_files
+        }
+        pending = [month_file for month_file, r in month_results.items() if r is None]
+        if len(pending) < MIN_POOL_MONTHS:
+            # Spawning workers and rebuilding the Geocoder in each costs more
+            # than parsing a couple of months here
+            parsed = [self.parse_month_file(month_file) for month_file in pending]
+        else:
+            # Month files are independent, parse every year's months in one
+            # pool so the workers and their Geocoder are only built once.
+            # Forking after numba has started its worker threads can
+            # deadlock, so always spawn.
+            with ProcessPoolExecutor(
+                max_workers=min(len(pending), os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self,),
+            ) as executor:
+                parsed = list(executor.map(_parse_month_file, pending))
+        if pending:
+            self._remove_legacy_cache_entries()
+        for month_file, month_result in zip(pending, parsed):
+            self._store_cached_month(month_file, month_result)
+            month_results[month_file] = month_result
+        for month_file in month_files:
+            result.update(month_results[month_file])
+
+    def _month_cache_path(self, month_file: Path) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        # One entry per month file, overwritten whenever its key changes
+        digest = hashlib.sha256(str(month_file.resolve()).encode()).hexdigest()
+        return self.cache_dir / f"{digest}.json"
+
+    def _month_cache_key(self, month_file: Path) -> str:
+        stat = month_file.stat()
+        return repr(
+            (
+                PARSE_CACHE_VERSION,
+                str(month_file.resolve()),
+                stat.st_mtime_ns,
+                stat.st_size,
+                self.geocoder.cache_key,
+                str(self.timezone),
+            )
+        )
+
+    def _load_cached_month(self, month_file: Path) -> Optional[VisitMap]:
+        cache_path = self._month_cache_path(month_file)
+        if cache_path is None or not cache_path.exists():
+            return None
+        try:
+            entry = orjson.loads(cache_path.read_bytes())
+            if entry["key"] != self._month_cache_key(month_file):
+                return None
+            return VisitMap.from_data((entry["state_names"], dict(entry["visits"])))
+        except (OSError, KeyError, TypeError, ValueError):
+            logger.debug("Ignoring unreadable cache entry %s", cache_path)
+            return None
+
+    def _store_cached_month(self, month_file: Path, month_result: VisitMap) -> None:
+        cache_path = self._month_cache_path(month_file)
+        if cache_path is None:
+            return
+        state_names, visits = month_result.to_data()
+        entry = {
+            "key": self._month_cache_key(month_file),
+            "state_names": state_names,
+            "visits": list(visits.items()),
+        }
+        # Caching is best-effort, an unwritable cache dir must not lose the report
+        tmp_name = None
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so concurrent runs never see a partial entry
+            with tempfile.NamedTemporaryFile(
+                dir=cache_path.parent, suffix=".tmp", delete=False
+            ) as tmp:
+                tmp_name = tmp.name
+                tmp.write(orjson.dumps(entry))
+            os.replace(tmp_name, cache_path)
+        except OSError as e:
+            logger.debug("Not caching %s: %s", month_file, e)
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+    def _remove_legacy_cache_entries(self) -> None:
+        # Older versions pickled one entry per file version and never
+        # replaced them
+        if self.cache_dir is None:
+            return
+        for legacy_path in self.cache_dir.glob("*.pkl"):
+            try:
+                legacy_path.unlink()
+            except OSError:
+                pass
 
     def count_state_days(
         self,
@@ -352,18 +948,17 @@ class TakeoutParser:
         state: str,
     ) -> List[Tuple[date, str, DayType]]:
         details: List[Tuple[date, str, DayType]] = []
-        visit_map: DefaultDict[date, Set[Tuple[str, bool]]] = defaultdict(set)
-        years = set()
+        visit_map = VisitMap()
         last_state = state
+        self.calendar.warmup(start_date, end_date)
         self.parse_location_history_file(visit_map, start_date, end_date)
-        for d in daterange(start_date, end_date):
-            if d.year not in years:
-                self.parse_semantic_year(d.year, visit_map)
-                years.add(d.year)
-            if d not in visit_map:
+        self.parse_semantic_years(range(start_date.year, end_date.year + 1), visit_map)
+        for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1):
+            d = date.fromordinal(ordinal)
+            visit_day = visit_map.visits(ordinal)
+            if not visit_day:
                 details.append((d, last_state, self.calendar.day_type(d)))
             else:
-                visit_day = visit_map[d]
                 day_type = self.calendar.day_type(d)
                 for visits in visit_day:
                     if visits[1] and day_type == DayType.WORKING:
@@ -389,6 +984,27 @@ class TakeoutParser:
         return details
 
 
+def _month_file_order(month_file: Path) -> Tuple[int, str]:
+    """Sort key putting "2019_JANUARY.json" before "2019_FEBRUARY.json"."""
+    month = month_file.stem.partition("_")[2]
+    return MONTH_NUMBERS.get(month, len(MONTH_NUMBERS) + 1), month_file.name
+
+
+_worker_parser: Optional[TakeoutParser] = None
+
+
+def _init_worker(parser: TakeoutParser) -> None:
+    global _worker_parser
+    # The pool already runs a worker per core, keep numba's parallel kernels
+    # from starting another thread per core inside each of them
+    set_num_threads(1)
+    _worker_parser = parser
+
+
+def _parse_month_file(month_file: Path) -> VisitMap:
+    return _worker_parser.parse_month_file(month_file)
+
+
 OFFICE_LOCATIONS = [
     Location(37.760377, -122.413178),
     Location(47.605076, -122.336696),
@@ -421,6 +1037,14 @@ OFFICE_LOCATIONS = [
 @click.option("--csv-out", help="CSV Output")
 @click.option("--start-date", required=False, help="First day to count")
 @click.option("--end-date", required=False, help="Last day to count")
+@click.option(
+    "--cache-dir",
+    default=str(Path.home() / ".audit_cache"),
+    show_default=True,
+    help="Directory to cache parsed Semantic Location History files in",
+)
+@click.option("--no-cache", is_flag=True, help="Don't read or write the cache")
+@click.option("--verbose", "-v", is_flag=True, help="Log progress while parsing")
 def days_in_state(
     takeout_dir: str,
     states_geojson: str,
@@ -429,11 +1053,22 @@ def days_in_state(
     csv_out: str,
     start_date: str,
     end_date: str,
+    cache_dir: str,
+    no_cache: bool,
+    verbose: bool,
 ):
+    logging.basicConfig(format="\t%(message)s")
+    logger.setLevel(logging.DEBUG if verbose else logging.WARNING)
     geocoder = Geocoder(Path(states_geojson), Path(countries_geojson), OFFICE_LOCATIONS)
     calendar = Calendar(["Columbus Day", "Veterans Day"])
-    timezone = pytz.timezone(us.states.lookup(state).capital_tz)
-    parser = TakeoutParser(geocoder, calendar, timezone, Path(takeout_dir))
+    timezone = ZoneInfo(us.states.lookup(state).capital_tz)
+    parser = TakeoutParser(
+        geocoder,
+        calendar,
+        timezone,
+        Path(takeout_dir),
+        None if no_cache else Path(cache_dir).expanduser(),
+    )
 
     start = dateutil.parser.parse(start_date).date()
     end = dateutil.parser.parse(end_date).date()
@@ -443,23 +1078,25 @@ def days_in_state(
         end,
         state,
     )
-    days_working = sum(x[2] == DayType.WORKING for x in details)
-    days_working_by_state = Counter(x[1] for x in details if x[2] == DayType.WORKING)
+    days_working_by_state = Counter(
+        day_state for _, day_state, day_type in details if day_type == DayType.WORKING
+    )
+    days_working = sum(days_working_by_state.values())
     click.echo(f"Report:")
     click.echo(f"\tTotal Days Worked: {days_working}")
     for state, days_worked in days_working_by_state.most_common():
         click.echo(f"\tTotal Days Worked in {state}: {days_worked}")
     if csv_out:
-        result = [{"Day": x + 1} for x in range(31)]
-        for day in details:
-            value = f"{day[1]},{day[2].value}" if day[2] != DayType.WEEKEND else ""
-            result[day[0].day - 1][day[0].strftime("%b")] = value
-        with open(csv_out, "w", newline="") as csvfile:
-            field_names = ["Day"] + [month_abbr[x] for x in range(1, 13)]
-            writer = csv.DictWriter(csvfile, fieldnames=field_names)
-            writer.writeheader()
-            for row in result:
-                writer.writerow(row)
+        # One row per day of the month, one column per month
+        rows = [[day] + [""] * 12 for day in range(1, 32)]
+        for d, day_state, day_type in details:
+            rows[d.day - 1][d.month] = (
+                f"{day_state},{day_type.value}" if day_type != DayType.WEEKEND else ""
+            )
+        with open(csv_out, "w", newline="", buffering=1 << 20) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Day"] + [month_abbr[x] for x in range(1, 13)])
+            writer.writerows(rows)
 
 
 if __name__ == "__main__":